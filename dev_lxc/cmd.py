@@ -1,27 +1,57 @@
 #!/usr/bin/env python3
-import argparse
+import functools
 import os
-import random
-import string
+import secrets
 import subprocess
 import sys
 
-try:
-    import yaml
-    PY_YAML = True
-except ImportError:
-    PY_YAML = False
-
 SERIES = ["bionic", "focal", "jammy", "noble", "oracular", "plucky"]
 DAILY_SERIES = "plucky"
 
+# Leading `lxc exec` arguments for running as the instance's default user.
+_EXEC_USER_ARGS = ("lxc", "exec", "--user", "1000", "--group", "1000")
+_EXEC_ENV_ARGS = ("--env", "HOME=/home/ubuntu", "--env", "USER=ubuntu")
+
+# Runs each dev-lxc-exec entry passed as an argument with its own `bash -c`, so
+# that e.g. `set -e` inside an entry behaves as it would on its own. A failing
+# entry is reported but doesn't stop the rest.
+_EXEC_CONFIG_SCRIPT = """\
+status=0
+for command in "$@"; do
+    printf 'Executing: %s\\n' "$command"
+    bash -c "$command" || {
+        printf 'ERROR: dev-lxc-exec command failed: %s\\n' "$command" >&2
+        status=1
+    }
+done
+exit $status
+"""
+
+# Instance statuses already fetched during this invocation, keyed by instance name.
+_STATUS_CACHE: dict[str, str] = {}
+
 
 def create(series: str, config: str = "", profile: str = ""):
-    proj_dir = os.path.basename(os.getcwd())
-    instance_name = os.path.basename(proj_dir) + f"-{series}"
+    instance_name = _instance_name(series)
+
+    # Check this before reading the config, which is no use for an existing instance.
+    if _get_status(instance_name) != "NONEXISTENT":
+        print(f"ERROR: Instance {instance_name} already exists")
+        sys.exit(4)
+
+    # Read once; the same bytes go to `lxc launch` and to the YAML parser.
+    if config:
+        try:
+            with open(config, "rb") as config_fp:
+                config_input = config_fp.read()
+        except OSError as e:
+            print(f"ERROR: Could not read LXD config from {config}: {e}")
+            config_input = None
+    else:
+        config_input = None
 
-    _create_container(instance_name, series, config, profile)
-    _exec_config(series, config)
+    _create_container(instance_name, series, config_input, profile)
+    _exec_config(series, config, config_input)
 
     print("All done! ✨ 🍰 ✨")
     print(
@@ -33,76 +63,41 @@ Jump into your new instance with:
 
 
 def shell(series: str, stop_after: bool):
-    proj_dir = os.path.basename(os.getcwd())
-    lxc_repo_path = f"/home/ubuntu/{os.path.basename(proj_dir)}"
-    instance_name = os.path.basename(proj_dir) + f"-{series}"
+    instance_name = _instance_name(series)
 
     _start_if_stopped(instance_name)
 
-    subprocess.run(
-        [
-            "lxc",
-            "exec",
-            "--user",
-            "1000",
-            "--group",
-            "1000",
-            "--cwd",
-            lxc_repo_path,
-            "--env",
-            "HOME=/home/ubuntu",
-            "--env",
-            "USER=ubuntu",
-            instance_name,
-            "bash",
-        ],
-    )
+    run_args = _exec_args(instance_name) + ["bash"]
 
-    if stop_after:
-        print(f"Stopping {instance_name}")
-        stop(series)
+    if not stop_after:
+        # Nothing left to do afterwards, so hand the process over to the shell.
+        sys.stdout.flush()
+        os.execvp(run_args[0], run_args)
+
+    subprocess.run(run_args)
+
+    print(f"Stopping {instance_name}")
+    stop(series)
 
 
 def remove(series: str):
-    proj_dir = os.path.basename(os.getcwd())
-    instance_name = os.path.basename(proj_dir) + f"-{series}"
+    instance_name = _instance_name(series)
 
     _remove(instance_name)
 
 
 def exec_cmd(series: str, command: str, stop_after: bool, emphemeral: bool, *env_args):
-    proj_dir = os.path.basename(os.getcwd())
-    lxc_repo_path = f"/home/ubuntu/{os.path.basename(proj_dir)}"
-
     if emphemeral:
-        ident = "".join(random.sample(string.ascii_lowercase, 12))
-        instance_name = os.path.basename(proj_dir) + f"-{series}-{ident}"
+        ident = secrets.token_hex(6)
+        instance_name = _instance_name(series) + f"-{ident}"
         _create_container(instance_name, series)
     else:
-        instance_name = os.path.basename(proj_dir) + f"-{series}"
+        instance_name = _instance_name(series)
 
     _start_if_stopped(instance_name)
 
-    run_args = [
-        "lxc",
-        "exec",
-        "--user",
-        "1000",
-        "--group",
-        "1000",
-        "--cwd",
-        lxc_repo_path,
-        "--env",
-        "HOME=/home/ubuntu",
-        "--env",
-        "USER=ubuntu",
-        instance_name,
-    ]
-
-    for env_arg in env_args:
-        run_args.append("--env")
-        run_args.append(env_arg)
-
+    run_args = _exec_args(instance_name)
+    run_args += [arg for env_arg in env_args for arg in ("--env", env_arg)]
     run_args += ["--", "bash", "-c", command]
 
     result = subprocess.run(run_args)
@@ -122,34 +117,40 @@ def exec_cmd(series: str, command: str, stop_after: bool, emphemeral: bool, *env
 
 
 def start(series: str) -> None:
-    proj_dir = os.path.basename(os.getcwd())
-    instance_name = os.path.basename(proj_dir) + f"-{series}"
+    instance_name = _instance_name(series)
 
     _start_if_stopped(instance_name)
 
 
 def stop(series: str) -> None:
-    proj_dir = os.path.basename(os.getcwd())
-    instance_name = os.path.basename(proj_dir) + f"-{series}"
+    instance_name = _instance_name(series)
 
     _stop(instance_name)
 
 
-def _exec_config(series: str, config: str = "") -> None:
-    """Executes the `dev-lxc-exec` section of `config` in the container for `series`."""
-    if not config:
+def _exec_config(series: str, config: str, config_input: bytes | None) -> None:
+    """Executes the `dev-lxc-exec` section of `config` in the container for `series`.
+
+    `config_input` is the already-read contents of `config`.
+    """
+    if not config_input:
         return
 
-    if not PY_YAML:
+    # Imported here so that commands which never read a config don't pay for it.
+    try:
+        import yaml
+    except ImportError:
         print("PyYAML is not installed, skipping post-creation dev-lxc-exec")
         return
 
-    with open(config) as config_fp:
-        try:
-            config_dict = yaml.safe_load(config_fp)
-        except yaml.YAMLError as e:
-            print(f"ERROR: Could not parse YAML from {config}: {e}")
-            return
+    # Prefer the libyaml-backed loader when PyYAML was built against it.
+    safe_loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+    try:
+        config_dict = yaml.load(config_input, Loader=safe_loader)
+    except yaml.YAMLError as e:
+        print(f"ERROR: Could not parse YAML from {config}: {e}")
+        return
 
     if "dev-lxc-exec" not in config_dict:
         return
@@ -163,19 +164,32 @@ def _exec_config(series: str, config: str = "") -> None:
     if isinstance(dev_lxc_exec, str):
         dev_lxc_exec = [dev_lxc_exec]
 
-    for command in dev_lxc_exec:
-        print(f"Executing: {command}")
-        exec_cmd(series, str(command), False, False)
+    commands = [str(command) for command in dev_lxc_exec]
+
+    if not commands:
+        return
+
+    instance_name = _instance_name(series)
+
+    _start_if_stopped(instance_name)
+
+    # Run all of the commands in a single `lxc exec` session.
+    subprocess.run(
+        _exec_args(instance_name)
+        + ["--", "bash", "-c", _EXEC_CONFIG_SCRIPT, "dev-lxc-exec", *commands]
+    )
 
 
 def _create_container(
     instance_name: str,
     series: str,
-    config: str = "",
+    config_input: bytes | None = None,
     profile: str = "",
 ) -> None:
-    """Creates a new container with the given `instance_name`."""
-    proj_dir = os.path.basename(os.getcwd())
+    """Creates a new container with the given `instance_name`.
+
+    `config_input` is the contents of a LXD config to apply, if any.
+    """
     uid = os.getuid()
 
     if series == DAILY_SERIES:
@@ -183,26 +197,10 @@ def _create_container(
     else:
         remote = "ubuntu"
 
-    # If we can check instance info, we know it already exists.
-    info_call = subprocess.run(
-        ["lxc", "info", instance_name],
-        capture_output=True,
-    )
-
-    if info_call.returncode == 0:
+    if _get_status(instance_name) != "NONEXISTENT":
         print(f"ERROR: Instance {instance_name} already exists")
         sys.exit(4)
 
-    if config:
-        try:
-            with open(config, "rb") as config_fp:
-                config_input = config_fp.read()
-        except OSError as e:
-            print(f"ERROR: Could not read LXD config from {config}: {e}")
-            config_input = None
-    else:
-        config_input = None
-
     # Create the instance using the appropriate config.
     cmd = [
         "lxc",
@@ -218,6 +216,9 @@ def _create_container(
 
     subprocess.run(cmd, input=config_input, check=True)
 
+    # `lxc launch` starts the instance, so there's no need to ask.
+    _STATUS_CACHE[instance_name] = "RUNNING"
+
     # Wait for cloud-init to finish.
     print(
         f"Waiting for {instance_name} to complete initialization and package installation"
@@ -225,10 +226,13 @@ def _create_container(
     )
     subprocess.run(
         ["lxc", "exec", instance_name, "--", "cloud-init", "status", "--wait"],
+        stdin=subprocess.DEVNULL,
     )
 
-    # Mount the filesystem.
-    lxc_repo_path = f"/home/ubuntu/{os.path.basename(proj_dir)}"
+    # Mount the filesystem. This has to wait for cloud-init: it creates the
+    # ubuntu user's home directory, and mounting first would leave that
+    # directory owned by root.
+    lxc_repo_path = f"/home/ubuntu/{_proj_dir()}"
     subprocess.run(
         [
             "lxc",
@@ -245,35 +249,55 @@ def _create_container(
     )
 
 
+def _exec_args(instance_name: str) -> list[str]:
+    """Returns `lxc exec` arguments to run as `ubuntu` in the project directory."""
+    return [
+        *_EXEC_USER_ARGS,
+        "--cwd",
+        f"/home/ubuntu/{_proj_dir()}",
+        *_EXEC_ENV_ARGS,
+        instance_name,
+    ]
+
+
 def _get_status(instance_name: str) -> str:
     """Gets the current status of the dev container for `series`."""
+    if instance_name in _STATUS_CACHE:
+        return _STATUS_CACHE[instance_name]
 
-    try:
-        result = subprocess.run(
-            ["lxc", "info", instance_name],
-            capture_output=True,
-            check=True,
-            text=True,
-        )
-    except subprocess.CalledProcessError as e:
-        if "Instance not found" in e.stderr:
-            return "NONEXISTENT"
-        raise e
+    _STATUS_CACHE[instance_name] = status = _query_status(instance_name)
+    return status
+
+
+def _query_status(instance_name: str) -> str:
+    """Queries LXD for the current status of `instance_name`."""
+    result = subprocess.run(
+        ["lxc", "list", "--columns", "ns", "--format", "csv", f"^{instance_name}$"],
+        capture_output=True,
+        check=True,
+        text=True,
+    )
 
-    # Poor-person's YAML decoder.
-    for line in result.stdout.splitlines():
-        line = line.strip()
+    # Name filters are regexes, so the anchored pattern matches at most one row.
+    rows = result.stdout.splitlines()
 
-        if not line:
-            continue
+    if not rows:
+        return "NONEXISTENT"
 
-        k, v = line.split(":", 1)
-        v = v.strip()
+    _, status = rows[0].split(",", 1)
 
-        if k == "Status":
-            return v
+    return status.upper() or "UNKNOWN"
 
-    return "UNKNOWN"
+
+@functools.cache
+def _proj_dir() -> str:
+    """Returns the name of the current project directory."""
+    return os.path.basename(os.getcwd())
+
+
+def _instance_name(series: str) -> str:
+    """Returns the name of this project's instance for `series`."""
+    return f"{_proj_dir()}-{series}"
 
 
 def _remove(instance_name: str) -> None:
@@ -284,7 +308,9 @@ def _remove(instance_name: str) -> None:
             "--force",
             instance_name,
         ],
+        stdin=subprocess.DEVNULL,
     )
+    _STATUS_CACHE.pop(instance_name, None)
 
     if result.returncode:
         # Output from the above goes to stdout/err so it should be apparent
@@ -300,14 +326,24 @@ def _start_if_stopped(instance_name: str) -> None:
 
     if status == "STOPPED":
         print(f"Starting {instance_name}")
-        subprocess.run(["lxc", "start", instance_name])
+        result = subprocess.run(["lxc", "start", instance_name], stdin=subprocess.DEVNULL)
+
+        # We know what a successful start leaves behind, so later callers
+        # don't need to ask LXD again.
+        if result.returncode:
+            _STATUS_CACHE.pop(instance_name, None)
+        else:
+            _STATUS_CACHE[instance_name] = "RUNNING"
 
 
 def _stop(instance_name: str) -> None:
-    subprocess.run(["lxc", "stop", instance_name])
+    subprocess.run(["lxc", "stop", instance_name], stdin=subprocess.DEVNULL)
+    _STATUS_CACHE.pop(instance_name, None)
 
 
 def main():
+    import argparse
+
     parser = argparse.ArgumentParser(
         prog="dev_lxc",
         description="Create, shell into, and remove developer containers",
@@ -319,13 +355,15 @@ def main():
         "create",
         help="creates a container using the given Ubuntu series as a base",
     )
-    create_parser.set_defaults(func=create)
+    create_parser.set_defaults(
+        func=lambda args: create(args.series, args.config, args.profile),
+    )
 
     shell_parser = subparsers.add_parser(
         "shell",
         help="create a bash session in the given series's container",
     )
-    shell_parser.set_defaults(func=shell)
+    shell_parser.set_defaults(func=lambda args: shell(args.series, args.stop_after))
     shell_parser.add_argument(
         "--stop-after",
         action="store_true",
@@ -336,13 +374,21 @@ def main():
         "remove",
         help="removes a container identified by Ubuntu series",
     )
-    remove_parser.set_defaults(func=remove)
+    remove_parser.set_defaults(func=lambda args: remove(args.series))
 
     exec_parser = subparsers.add_parser(
         "exec",
         help="executes an arbitrary command in the given series's container",
     )
-    exec_parser.set_defaults(func=exec_cmd)
+    exec_parser.set_defaults(
+        func=lambda args: exec_cmd(
+            args.series,
+            args.command,
+            args.stop_after,
+            args.ephemeral,
+            *args.env,
+        ),
+    )
     exec_parser.add_argument("--env", nargs="*", default=[])
     exec_parser.add_argument(
         "--stop-after",
@@ -359,13 +405,13 @@ def main():
         "start",
         help="starts the given series's container",
     )
-    start_parser.set_defaults(func=start)
+    start_parser.set_defaults(func=lambda args: start(args.series))
 
     stop_parser = subparsers.add_parser(
         "stop",
         help="stops the given series's container",
     )
-    stop_parser.set_defaults(func=stop)
+    stop_parser.set_defaults(func=lambda args: stop(args.series))
 
     for subparser in (
         create_parser,
@@ -399,21 +445,7 @@ def main():
     exec_parser.add_argument("command", type=str, help="The command to execute")
 
     parsed = parser.parse_args(sys.argv[1:])
-
-    if hasattr(parsed, "env"):
-        parsed.func(
-            parsed.series,
-            parsed.command,
-            parsed.stop_after,
-            parsed.ephemeral,
-            *parsed.env,
-        )
-    elif hasattr(parsed, "stop_after"):
-        parsed.func(parsed.series, parsed.stop_after)
-    elif hasattr(parsed, "config"):
-        parsed.func(parsed.series, parsed.config, parsed.profile)
-    else:
-        parsed.func(parsed.series)
+    parsed.func(parsed)
 
 
 if __name__ == "__main__":